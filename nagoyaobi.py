@@ -9,12 +9,22 @@
 #
 ###########################################################################################
 
+import array
 import copy
+import gc
 import io
+import itertools
+import json
 import math
+import multiprocessing
 import nkf
+import random
 import re
 import regression
+import struct
+import sys
+from collections.abc import Mapping
+from multiprocessing import shared_memory
 from typing import Generator
 from typing import TextIO
 from typing import Tuple
@@ -22,51 +32,95 @@ from typing import Tuple
 
 __N = 2
 __KanjiCode = None
+__WorkerModel = None
+__WorkerOperative = None
+__WorkerSmoothing = None
+__WorkerMemory = 0
+
+
+class Estimation(dict):
+	"""
+	Likelihood estimation per method, computed on first access
+	"""
+	__slots__ = ['contrib']
+
+	def __init__(self, contrib: list):
+		super().__init__()
+		self.contrib = contrib
+
+	def __missing__(self, method: str) -> list:
+		operative_len = self.contrib[0]
+		if operative_len <= 0 or method not in Result.MethodList:
+			raise KeyError(method)
+		if method == 'ns':
+			value = [100 * self.contrib[i] / operative_len for i in range(1, len(self.contrib))]
+		else:
+			value = regression.regression(int(method[1:]), self['ns'], None)
+		self[method] = value
+		return value
 
 
 class Result:
 	MethodList = ['ns', 's5', 's4', 's3', 's2']
 	VotingList = ['ns', 's4', 's2']
 
+	__slots__ = ['text', 'contrib', 'model_spec', 'voting_list', 'estimate', 'final_cache']
+
 	def __init__(self, text: dict, contrib: list, model_spec: str = None, smoothing: list = None):
 		self.text = text
 		self.contrib = contrib
+		self.model_spec = model_spec
 		self.voting_list = self.VotingList
 		self.estimate = self.make_estimation(self.contrib)
+		self.final_cache = None
 		if smoothing:
-			self.set_voting_list(['ns' if v == 0 else f's{v}' for v in smoothing])
-		if model_spec == 'T7':
-			self.final = [self.t7_scale_transform(v) for v in self.final_estimation(self.estimate)]
-		else:
-			self.final = self.final_estimation(self.estimate)
+			self.set_voting_list(self.smoothing_to_voting_list(smoothing))
+
+	@staticmethod
+	def smoothing_to_voting_list(smoothing: list) -> list:
+		return ['ns' if v == 0 else f's{v}' for v in smoothing]
 
 	def set_voting_list(self, list: list):
 		self.voting_list = list
+		self.final_cache = None
 
 	def make_estimation(self, contrib: list) -> dict:
-		estimat = dict()
-
-		operative_len = contrib[0]
-		if operative_len > 0:
-			estimat['ns'] = [100 * contrib[i] / operative_len for i in range(1, len(contrib))]
-			for i in range(2, 6):
-				estimat[f's{i}'] = regression.regression(i, estimat['ns'], None)
-		return estimat
-
-	def final_estimation(self, estimat: dict) -> list:
-		if len(estimat) > 0:
-			list = [estimat[x].index(max(estimat[x]))+1 for x in self.MethodList]
-			temp = sorted([estimat[x].index(max(estimat[x]))+1 for x in self.voting_list])
-			return [temp[int(len(temp)/2)]] + list if int(len(temp)) % 2 != 0 \
-				else [(temp[int(len(temp)/2-1)] + temp[int(len(temp)/2)]) / 2] + list
+		return Estimation(contrib)
+
+	@property
+	def final(self) -> list:
+		if self.final_cache is None:
+			if self.model_spec == 'T7':
+				self.final_cache = [self.t7_scale_transform(v) for v in self.final_estimation()]
+			else:
+				self.final_cache = self.final_estimation()
+		return self.final_cache
+
+	def best(self, method: str) -> int:
+		estimat = self.estimate[method]
+		return estimat.index(max(estimat)) + 1
+
+	def vote(self):
+		temp = sorted([self.best(x) for x in self.voting_list])
+		return temp[int(len(temp)/2)] if int(len(temp)) % 2 != 0 \
+			else (temp[int(len(temp)/2-1)] + temp[int(len(temp)/2)]) / 2
+
+	def final_estimation(self) -> list:
+		if self.contrib[0] > 0:
+			return [self.vote()] + [self.best(x) for x in self.MethodList]
 		else:
 			return [0] * len(self.MethodList)
 
 	def grade(self, t7=None) -> int:
-		if t7:
-			return self.t7_scale_transform(self.final[0])
+		if self.final_cache is not None:
+			grade = self.final_cache[0]
+		elif self.contrib[0] <= 0:
+			grade = 0
+		elif self.model_spec == 'T7':
+			grade = self.t7_scale_transform(self.vote())
 		else:
-			return self.final[0]
+			grade = self.vote()
+		return self.t7_scale_transform(grade) if t7 else grade
 
 	def t7_scale_transform(self, val: int) -> int:
 		if val == 0:
@@ -95,20 +149,41 @@ class Result:
 				print(*c, end='\n')
 			print('\n')
 
-		if 'likelihood' in param and param['likelihood']:
+		if 'likelihood' in param and param['likelihood'] and self.contrib[0] > 0:
 			for v in self.MethodList:
-				print(*[v, f'{self.estimate[v].index(max(self.estimate[v])+1):2d}',
-						' '.join([f'{x:6.2f}' for x in self.estimate[v]])], end='\n')
+				print(*[v, f'{self.best(v):2d}', ' '.join([f'{x:6.2f}' for x in self.estimate[v]])], end='\n')
 
 		if ('long' in param and param['long']) or ('likelihood' in param and param['likelihood']):
 			out = info + self.final + [self.contrib[0]] if 'tail' in param and param['tail'] else self.final + [self.contrib[0]] + info
+			print(*out, sep=separator, end='\n')
 		else:
-			out = info + [self.final[0], self.contrib[0]] if 'tail' in param and param['tail'] else [self.final[0], self.contrib[0]] + info
-		print(*out, sep=separator, end='\n')
+			self.show_grade(self.grade(), self.contrib[0], info, param)
 		if 'likelihood' in param and param['likelihood']:
 			print('\n')
 		return self
 
+	@staticmethod
+	def show_grade(grade, operative_len: int, info: list = [], param: dict = {}) -> None:
+		"""
+		Default output (grade and operative length) for results kept as tuples
+		"""
+		separator = ' '
+		if 'separator' in param and param['separator']:
+			separator = param['separator']
+		out = info + [grade, operative_len] if 'tail' in param and param['tail'] else [grade, operative_len] + info
+		print(*out, sep=separator, end='\n')
+
+	def record(self, id, param: dict = {}) -> dict:
+		"""
+		Result as a JSON-serializable record
+		"""
+		record = {'id': id, 'grade': self.grade(), 'operative': self.contrib[0]}
+		if ('long' in param and param['long']) or ('likelihood' in param and param['likelihood']):
+			record['estimation'] = self.final
+		if 'likelihood' in param and param['likelihood'] and self.contrib[0] > 0:
+			record['likelihood'] = {v: self.estimate[v] for v in self.MethodList}
+		return record
+
 
 class Model:
 	def __init__(self, model: dict, spec: str = None):
@@ -134,18 +209,558 @@ class Model:
 		total = [0]
 		for key in list(text.keys()):
 			if key in self.model:
+				w = self.model[key]
 				total[0] += text[key][0]
-				for i in range(1, len(self.model[key])):
+				for i in range(1, len(w)):
 					if len(total) <= i:
 						total.append(0.0)
 					if len(text[key]) <= i:
 						text[key].append(0.0)
-					text[key][i] = text[key][0] * self.model[key][i]
+					text[key][i] = text[key][0] * w[i]
 					total[i] += text[key][i]
 			else:
 				del text[key]  # Not a valid bigram!
 		return total
 
+	def score_counts(self, text: dict) -> list:
+		"""
+		Calculate likelihood totals without modifying text
+		"""
+		model = self.model
+		total = [0]
+		for key, c in text.items():
+			w = model.get(key)
+			if w is not None:
+				n = c[0]
+				if len(total) < len(w):
+					total += [0.0] * (len(w) - len(total))
+				total[0] += n
+				for i in range(1, len(w)):
+					total[i] += n * w[i]
+		return total
+
+	def readability_approx(self, io_spec, kanji_code_spec: str, op_char: dict, smoothing: list = None,
+						   step: int = 2000, stable: int = 3, tolerance: float = 1.0, sample: float = 1.0,
+						   seed: int = 0) -> Tuple[Result, bool]:
+		"""
+		Evaluate increasing prefixes of the text until the estimation settles
+
+		Every step n-grams the grade and the normalized likelihoods (ns) are checked; evaluation
+		stops once the grade is unchanged and no likelihood moved more than tolerance for stable
+		consecutive checks. With sample < 1.0 only that fraction of lines is read.
+		Returns the result and whether the whole text was consumed (never when lines were sampled).
+		"""
+		if step < 1 or stable < 1 or not 0.0 < sample <= 1.0:
+			raise ValueError(f'invalid approximation step={step}, stable={stable}, sample={sample}')
+		if isinstance(io_spec, str):
+			with open(io_spec, 'r', encoding='utf-8') as f:
+				return self.readability_approx(f, kanji_code_spec, op_char, smoothing, step, stable, tolerance,
+											   sample, seed)
+
+		kanji_code = get_kanji_code(kanji_code_spec)
+		if sample >= 1.0:
+			ngrams = operative_ngram_from_io(io_spec, kanji_code, op_char)
+		else:
+			# Each sampled line is read on its own so no n-gram spans skipped lines
+			rng = random.Random(seed)
+			ngrams = (b for line in io_spec if rng.random() < sample
+					  for b in operative_ngram_from_io([line], kanji_code, op_char))
+		text = dict()
+		pending = dict()  # Frequencies read since the last check
+		total = [0]
+		result = None
+		settled = 0
+		count = 0
+		for b in ngrams:
+			if b not in text:
+				text[b] = [0]
+			text[b][0] += 1
+			if b not in pending:
+				pending[b] = [0]
+			pending[b][0] += 1
+			count += 1
+			if count % step == 0:
+				total = add_likelihoods(total, self.score_counts(pending))
+				pending = dict()
+				previous = result
+				result = Result(text, total.copy(), self.model_spec, smoothing)
+				if previous and previous.grade() == result.grade() and previous.contrib[0] > 0 and \
+						max(abs(x - y) for x, y in zip(previous.estimate['ns'], result.estimate['ns'])) <= tolerance:
+					settled += 1
+					if settled >= stable:
+						return result, False
+				else:
+					settled = 0
+		total = add_likelihoods(total, self.score_counts(pending))
+		return Result(text, total, self.model_spec, smoothing), sample >= 1.0
+
+	def readability_tuple(self, io_spec, kanji_code_spec: str, op_char: dict, smoothing: list = None) \
+			-> Tuple[int, int]:
+		return self.grade_tuple(load_text(io_spec, kanji_code_spec, op_char), smoothing)
+
+	def grade_tuple(self, text: dict, smoothing: list = None) -> Tuple[int, int]:
+		"""
+		(grade, operative length) of text, without modifying or keeping text
+		"""
+		return self.grade_contrib(self.score_counts(text), smoothing)
+
+	def grade_contrib(self, contrib: list, smoothing: list = None) -> Tuple[int, int]:
+		return Result(None, contrib, self.model_spec, smoothing).grade(), contrib[0]
+
+	def score_batch(self, texts: list) -> list:
+		"""
+		Calculate likelihood totals for a batch of texts
+		"""
+		return [self.score_counts(text) for text in texts]
+
+	def readability_stream(self, records, op_char: dict, smoothing: list = None,
+						   batch_size: int = 1) -> Generator[Tuple[object, Result], None, None]:
+		"""
+		Evaluate each (id, text) record as its own document
+		"""
+		for batch in batched(records, batch_size):
+			texts = [load_text(text.splitlines(), None, op_char) for _, text in batch]
+			for (id, _), text, contrib in zip(batch, texts, self.score_batch(texts)):
+				yield id, Result(text, contrib, self.model_spec, smoothing)
+
+	def grade_stream(self, records, op_char: dict, smoothing: list = None,
+					 batch_size: int = 1) -> Generator[Tuple[object, int, int], None, None]:
+		"""
+		Evaluate each (id, text) record as its own document, yielding (id, grade, operative length)
+		"""
+		for batch in batched(records, batch_size):
+			texts = [load_text(text.splitlines(), None, op_char) for _, text in batch]
+			for (id, _), contrib in zip(batch, self.score_batch(texts)):
+				yield (id,) + self.grade_contrib(contrib, smoothing)
+
+
+class QuantizedWeights(Mapping):
+	"""
+	Read-only view of quantized weights in the Model.model layout ([frequency, w1, ..., wN])
+	"""
+	def __init__(self, index: dict, frequency: array.array, weights: array.array, scale: float, grades: int):
+		self.index = index
+		self.frequency = frequency
+		self.weights = weights
+		self.scale = scale
+		self.grades = grades
+
+	def __getitem__(self, key: str) -> list:
+		row = self.index[key]
+		offset = row * self.grades
+		return [self.frequency[row]] + [w * self.scale for w in self.weights[offset:offset + self.grades]]
+
+	def __contains__(self, key) -> bool:
+		return key in self.index
+
+	def __iter__(self):
+		return iter(self.index)
+
+	def __len__(self) -> int:
+		return len(self.index)
+
+
+class QuantizedModel(Model):
+	"""
+	Model with weights stored as int8/int16 with a per-model scale, or as float16
+	"""
+	Magic = b'OBIQ'
+	Kinds = {'int8': ('b', 'b', 127), 'int16': ('h', 'h', 32767), 'float16': ('f', 'e', None)}  # memory, file, range
+
+	def __init__(self, weights: QuantizedWeights, kind: str, spec: str = None):
+		super().__init__(weights, spec)
+		self.kind = kind
+
+	def save_model(self, model_output: str) -> None:
+		"""
+		Save quantized model
+		"""
+		w = self.model
+		keys = '\t'.join(w.index).encode('utf-8')
+		with open(model_output, 'wb') as f:
+			f.write(self.Magic + struct.pack('<cHdII', self.Kinds[self.kind][1].encode(), w.grades, w.scale,
+											 len(w.index), len(keys)))
+			f.write(keys)
+			f.write(struct.pack(f'<{len(w.frequency)}I', *w.frequency))
+			f.write(struct.pack(f'<{len(w.weights)}{self.Kinds[self.kind][1]}', *w.weights))
+
+	def readability0(self, text: dict, smoothing: list = None) -> Result:
+		return Result(text, self.score_counts(text), self.model_spec, smoothing)
+
+	def calculate_likelihoods(self, text: dict) -> list:
+		"""
+		Calculate likelihood totals and per-key contributions from the quantized weights
+		"""
+		w = self.model
+		index, weights, grades, scale = w.index, w.weights, w.grades, w.scale
+		total = [0]
+		for key in list(text.keys()):
+			row = index.get(key)
+			if row is not None:
+				n = text[key][0]
+				offset = row * grades
+				contrib = [n * q * scale for q in weights[offset:offset + grades]]
+				text[key][1:] = contrib
+				if len(total) == 1:
+					total += [0.0] * grades
+				total[0] += n
+				for i in range(grades):
+					total[i+1] += contrib[i]
+			else:
+				del text[key]  # Not a valid bigram!
+		return total
+
+	def score_counts(self, text: dict) -> list:
+		"""
+		Calculate likelihood totals without modifying text (scaled once at the end)
+		"""
+		w = self.model
+		index, weights, grades = w.index, w.weights, w.grades
+		total = [0] * (grades + 1)
+		for key, c in text.items():
+			row = index.get(key)
+			if row is not None:
+				n = c[0]
+				offset = row * grades
+				total[0] += n
+				for i, q in enumerate(weights[offset:offset + grades], 1):
+					total[i] += n * q
+		return total[:1] + [float(t) * w.scale for t in total[1:]] if total[0] > 0 else [0]
+
+
+class SharedWeights(Mapping):
+	"""
+	Read-only view of weights in a shared memory segment in the Model.model layout ([frequency, w1, ..., wN])
+
+	Keys are encoded as integers in an open addressing table so that lookups create only
+	short-lived objects and never touch the reference counts of shared pages.
+	"""
+	Header = '<QQQ'  # capacity, count, grades
+
+	def __init__(self, shm: shared_memory.SharedMemory):
+		self.shm = shm
+		self.capacity, self.count, self.grades = struct.unpack_from(self.Header, shm.buf)
+		offset = struct.calcsize(self.Header)
+		self.keys = shm.buf[offset:offset + 8 * self.capacity].cast('q')
+		offset += 8 * self.capacity
+		self.rows = shm.buf[offset:offset + 4 * self.capacity].cast('i')
+		offset += 4 * self.capacity
+		self.frequency = shm.buf[offset:offset + 8 * self.count].cast('q')
+		offset += 8 * self.count
+		self.weights = shm.buf[offset:offset + 8 * self.count * self.grades].cast('d')
+
+	@classmethod
+	def size(cls, capacity: int, count: int, grades: int) -> int:
+		return struct.calcsize(cls.Header) + 12 * capacity + 8 * count * (grades + 1)
+
+	@staticmethod
+	def encode(key: str) -> int:
+		return (ord(key[0]) << 22) | (ord(key[1]) + 1 if len(key) > 1 else 0)
+
+	@staticmethod
+	def decode(code: int) -> str:
+		second = (code & 0x3fffff) - 1
+		return chr(code >> 22) + (chr(second) if second >= 0 else '')
+
+	def slot(self, code: int) -> int:
+		mask = self.capacity - 1
+		i = (code * 0x9e3779b1 >> 16) & mask
+		while self.keys[i] != code and self.keys[i] != 0:
+			i = (i + 1) & mask
+		return i
+
+	def row(self, key: str) -> int:
+		"""
+		Row of key, or -1 if key is not in the model
+		"""
+		if not 1 <= len(key) <= 2:
+			return -1
+		code = self.encode(key)
+		i = self.slot(code)
+		return self.rows[i] if self.keys[i] == code else -1
+
+	def __getitem__(self, key: str) -> list:
+		row = self.row(key)
+		if row < 0:
+			raise KeyError(key)
+		offset = row * self.grades
+		return [self.frequency[row]] + self.weights[offset:offset + self.grades].tolist()
+
+	def __contains__(self, key) -> bool:
+		return isinstance(key, str) and self.row(key) >= 0
+
+	def __iter__(self):
+		return (self.decode(code) for code in self.keys if code != 0)
+
+	def __len__(self) -> int:
+		return self.count
+
+	def release(self) -> None:
+		for view in [self.keys, self.rows, self.frequency, self.weights]:
+			view.release()
+
+
+class SharedModel(Model):
+	"""
+	Model with weights and key index in a shared memory segment, for pre-fork worker pools
+	"""
+	def __init__(self, weights: SharedWeights, spec: str = None):
+		super().__init__(weights, spec)
+
+	@classmethod
+	def create(cls, model: Model) -> 'SharedModel':
+		"""
+		Copy model into a new shared memory segment
+		"""
+		count = len(model.model)
+		grades = max((len(v) - 1 for v in model.model.values()), default=0)
+		capacity = 2
+		while capacity < 2 * count:
+			capacity *= 2
+
+		shm = shared_memory.SharedMemory(create=True, size=SharedWeights.size(capacity, count, grades))
+		struct.pack_into(SharedWeights.Header, shm.buf, 0, capacity, count, grades)
+		weights = SharedWeights(shm)
+		for row, key in enumerate(model.model):
+			v = model.model[key]
+			i = weights.slot(SharedWeights.encode(key))
+			weights.keys[i] = SharedWeights.encode(key)
+			weights.rows[i] = row
+			weights.frequency[row] = v[0]
+			weights.weights[row * grades:(row + 1) * grades] = array.array('d', v[1:])
+		return cls(weights, model.model_spec)
+
+	@classmethod
+	def attach(cls, name: str, spec: str = None) -> 'SharedModel':
+		"""
+		Attach to the shared memory segment created by another process
+		"""
+		return cls(SharedWeights(shared_memory.SharedMemory(name=name)), spec)
+
+	def __reduce__(self):
+		return SharedModel.attach, (self.model.shm.name, self.model_spec)
+
+	def readability0(self, text: dict, smoothing: list = None) -> Result:
+		return Result(text, self.score_counts(text), self.model_spec, smoothing)
+
+	def close(self) -> None:
+		self.model.release()
+		self.model.shm.close()
+
+	def unlink(self) -> None:
+		self.close()
+		self.model.shm.unlink()
+
+	def score_counts(self, text: dict) -> list:
+		"""
+		Calculate likelihood totals without modifying text
+		"""
+		w = self.model
+		keys, rows, weights, grades, mask = w.keys, w.rows, w.weights, w.grades, w.capacity - 1
+		total = [0] + [0.0] * grades
+		for key, c in text.items():
+			# Inlined SharedWeights.row
+			if len(key) == 2:
+				code = (ord(key[0]) << 22) | (ord(key[1]) + 1)
+			elif len(key) == 1:
+				code = ord(key) << 22
+			else:
+				continue
+			i = (code * 0x9e3779b1 >> 16) & mask
+			k = keys[i]
+			while k != code and k != 0:
+				i = (i + 1) & mask
+				k = keys[i]
+			if k == code:
+				row = rows[i]
+				n = c[0]
+				offset = row * grades
+				total[0] += n
+				for i, x in enumerate(weights[offset:offset + grades].tolist(), 1):
+					total[i] += n * x
+		return total if total[0] > 0 else [0]
+
+
+def quantize_model(model: Model, kind: str) -> QuantizedModel:
+	"""
+	Quantize model weights (int8, int16 or float16)
+	"""
+	if kind not in QuantizedModel.Kinds:
+		raise ValueError(f'{kind} is not a valid quantization!')
+	typecode, file_typecode, limit = QuantizedModel.Kinds[kind]
+
+	grades = max((len(v) - 1 for v in model.model.values()), default=0)
+	if limit:
+		scale = max((abs(x) for v in model.model.values() for x in v[1:]), default=0.0) / limit or 1.0
+	else:
+		scale = 1.0
+
+	index = dict()
+	frequency = array.array('I')
+	weights = array.array(typecode)
+	for key in model.model:
+		v = model.model[key]
+		index[key] = len(frequency)
+		frequency.append(v[0])
+		if limit:
+			weights.extend(round(x / scale) for x in v[1:])
+		else:
+			weights.extend(struct.unpack(f'<{grades}e', struct.pack(f'<{grades}e', *v[1:])))
+	return QuantizedModel(QuantizedWeights(index, frequency, weights, scale, grades), kind, model.model_spec)
+
+
+def load_quantized_model_file(filename: str, required_frequency: int, model_spec: str = None) -> QuantizedModel:
+	with open(filename, 'rb') as f:
+		if f.read(len(QuantizedModel.Magic)) != QuantizedModel.Magic:
+			raise ValueError(f'{filename} is not a quantized model!')
+		file_typecode, grades, scale, count, size = struct.unpack('<cHdII', f.read(struct.calcsize('<cHdII')))
+		kind = [k for k, v in QuantizedModel.Kinds.items() if v[1] == file_typecode.decode()][0]
+		keys = f.read(size).decode('utf-8').split('\t') if count > 0 else []
+		freqs = struct.unpack(f'<{count}I', f.read(4 * count))
+		values = struct.unpack(f'<{count * grades}{file_typecode.decode()}',
+							   f.read(struct.calcsize(f'<{count * grades}{file_typecode.decode()}')))
+
+	index = dict()
+	frequency = array.array('I')
+	weights = array.array(QuantizedModel.Kinds[kind][0])
+	for row in range(count):
+		if freqs[row] >= required_frequency:
+			index[keys[row]] = len(frequency)
+			frequency.append(freqs[row])
+			weights.extend(values[row * grades:(row + 1) * grades])
+	return QuantizedModel(QuantizedWeights(index, frequency, weights, scale, grades), kind, model_spec)
+
+
+def compare_models(model: Model, other: Model, specs: list, op_char: dict, smoothing: list = None) -> list:
+	"""
+	Evaluate (io_spec, kanji_code) pairs with two models
+
+	Returns rows of [grade, other grade, operative length].
+	"""
+	rows = list()
+	for io_spec, kanji_code in specs:
+		text = load_text(io_spec, kanji_code, op_char)
+		grade, operative_len = model.grade_tuple(text, smoothing)
+		rows.append([grade, other.grade_tuple(text, smoothing)[0], operative_len])
+	return rows
+
+
+class DocumentStore:
+	"""
+	N-gram frequency vectors of documents in a compressed sparse row file with an id index
+	"""
+	Magic = b'OBID'
+	Header = '<QQQQQ'  # documents, terms, nonzeros, vocabulary bytes, id bytes
+
+	def __init__(self, vocabulary: list, ids: list, indptr: array.array, indices: array.array,
+				 counts: array.array):
+		self.vocabulary = vocabulary
+		self.ids = ids
+		self.indptr = indptr
+		self.indices = indices
+		self.counts = counts
+
+	def __len__(self) -> int:
+		return len(self.ids)
+
+	def rescore(self, model: Model, smoothing: list = None) -> Generator[Tuple[str, Result], None, None]:
+		"""
+		Evaluate every document with model
+
+		Model weights are looked up once per vocabulary entry; each document is then
+		the product of its sparse row and the resulting weight matrix.
+		"""
+		weights = [model.model.get(term) for term in self.vocabulary]
+		grades = max((len(w) - 1 for w in weights if w), default=0)
+		for d, id in enumerate(self.ids):
+			total = [0] + [0.0] * grades
+			for j in range(self.indptr[d], self.indptr[d+1]):
+				w = weights[self.indices[j]]
+				if w:
+					n = self.counts[j]
+					total[0] += n
+					for i in range(1, len(w)):
+						total[i] += n * w[i]
+			yield id, Result(dict(), total if total[0] > 0 else [0], model.model_spec, smoothing)
+
+
+class DocumentStoreWriter:
+	"""
+	Collect document frequencies and save them as a DocumentStore file
+	"""
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.vocabulary = dict()
+		self.ids = list()
+		self.id_set = set()
+		self.indptr = array.array('Q', [0])
+		self.indices = array.array('I')
+		self.counts = array.array('I')
+
+	def __enter__(self) -> 'DocumentStoreWriter':
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> None:
+		if exc_type is None:
+			self.close()
+
+	def add(self, id: str, text: dict) -> None:
+		if '\n' in id:
+			raise ValueError(f'{id!r} is not a valid document id!')
+		if id in self.id_set:
+			raise ValueError(f'{id!r} is a duplicate document id!')
+		self.id_set.add(id)
+		for key in text:
+			if key not in self.vocabulary:
+				self.vocabulary[key] = len(self.vocabulary)
+			self.indices.append(self.vocabulary[key])
+			self.counts.append(text[key][0])
+		self.ids.append(id)
+		self.indptr.append(len(self.indices))
+
+	def close(self) -> None:
+		vocabulary = '\n'.join(self.vocabulary).encode('utf-8')
+		ids = '\n'.join(self.ids).encode('utf-8')
+		with open(self.filename, 'wb') as f:
+			f.write(DocumentStore.Magic + struct.pack(DocumentStore.Header, len(self.ids), len(self.vocabulary),
+														len(self.indices), len(vocabulary), len(ids)))
+			f.write(vocabulary)
+			f.write(ids)
+			for a in [self.indptr, self.indices, self.counts]:
+				f.write(array_to_bytes(a))
+
+
+def array_to_bytes(a: array.array) -> bytes:
+	"""
+	Little-endian bytes of array
+	"""
+	if sys.byteorder == 'big':
+		a = array.array(a.typecode, a)
+		a.byteswap()
+	return a.tobytes()
+
+
+def array_from_bytes(typecode: str, data: bytes) -> array.array:
+	a = array.array(typecode)
+	a.frombytes(data)
+	if sys.byteorder == 'big':
+		a.byteswap()
+	return a
+
+
+def load_document_store(filename: str) -> DocumentStore:
+	with open(filename, 'rb') as f:
+		if f.read(len(DocumentStore.Magic)) != DocumentStore.Magic:
+			raise ValueError(f'{filename} is not a document store!')
+		documents, terms, nonzeros, vocabulary_size, id_size = \
+			struct.unpack(DocumentStore.Header, f.read(struct.calcsize(DocumentStore.Header)))
+		vocabulary = f.read(vocabulary_size).decode('utf-8').split('\n') if terms > 0 else []
+		ids = f.read(id_size).decode('utf-8').split('\n') if documents > 0 else []
+		indptr = array_from_bytes('Q', f.read(8 * (documents + 1)))
+		indices = array_from_bytes('I', f.read(4 * nonzeros))
+		counts = array_from_bytes('I', f.read(4 * nonzeros))
+	return DocumentStore(vocabulary, ids, indptr, indices, counts)
+
 
 def version() -> str:
 	return 'NagoyaObi 2.305 (2009-08-12) Copyright 2009, Satoshi Sato'
@@ -267,6 +882,114 @@ def operative_ngram_from_io(io: TextIO, kanji_code: str, op_char: dict, n: int =
 				yield b
 
 
+def approximation_agreement(model: Model, specs: list, op_char: dict, smoothing: list = None, **approx) -> list:
+	"""
+	Compare approximate and full evaluation of (io_spec, kanji_code) pairs
+
+	Returns rows of [full grade, approximate grade, full length, consumed length].
+	"""
+	rows = list()
+	for io_spec, kanji_code in specs:
+		full = model.readability(io_spec, kanji_code, op_char, smoothing)
+		result, _ = model.readability_approx(io_spec, kanji_code, op_char, smoothing, **approx)
+		rows.append([full.grade(), result.grade(), full.contrib[0], result.contrib[0]])
+	return rows
+
+
+def private_memory() -> int:
+	"""
+	Private memory of this process in kB (0 where /proc is not available)
+	"""
+	try:
+		with open('/proc/self/smaps_rollup', 'r') as f:
+			return sum(int(line.split()[1]) for line in f if line.startswith(('Private_Clean:', 'Private_Dirty:')))
+	except OSError:
+		return 0
+
+
+def init_worker(model: Model, op_char: dict, smoothing: list = None) -> None:
+	global __WorkerModel, __WorkerOperative, __WorkerSmoothing, __WorkerMemory
+	__WorkerModel = model
+	__WorkerOperative = op_char
+	__WorkerSmoothing = smoothing
+	__WorkerMemory = private_memory()
+
+
+def worker_readability(spec: tuple) -> Tuple[list, int]:
+	text = load_text(spec[0], spec[1], __WorkerOperative)
+	return __WorkerModel.score_counts(text), private_memory() - __WorkerMemory
+
+
+def worker_grade(spec: tuple) -> Tuple[Tuple[int, int], int]:
+	grade = __WorkerModel.readability_tuple(spec[0], spec[1], __WorkerOperative, __WorkerSmoothing)
+	return grade, private_memory() - __WorkerMemory
+
+
+def readability_pool(model: Model, specs: list, op_char: dict, smoothing: list = None, processes: int = None,
+					 light: bool = False) -> Generator[Tuple[object, int], None, None]:
+	"""
+	Evaluate (io_spec, kanji_code) pairs in a pre-fork worker pool
+
+	Yields each result with the private memory (kB) its worker has gained since it started.
+	With light, results are (grade, operative length) tuples instead of Result.
+	"""
+	gc.freeze()  # Keep the collector from writing to objects shared with the workers
+	try:
+		method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+		with multiprocessing.get_context(method).Pool(processes, init_worker, (model, op_char, smoothing)) as pool:
+			if light:
+				yield from pool.imap(worker_grade, specs)
+			else:
+				for contrib, memory in pool.imap(worker_readability, specs):
+					yield Result(dict(), contrib, model.model_spec, smoothing), memory
+	finally:
+		gc.unfreeze()
+
+
+def records_from_jsonl(io: TextIO, id_field: str = 'id', text_field: str = 'text', on_error=None,
+					   require_id: bool = False) -> Generator[Tuple[object, str], None, None]:
+	"""
+	Get (id, text) records from JSON Lines
+
+	Invalid records (and records without id when require_id) raise ValueError, or are skipped
+	after calling on_error(line number, id, message).
+	"""
+	for n, line in enumerate(io, 1):
+		if re.search(r'^\s*$', line):
+			continue
+		id = None
+		try:
+			try:
+				record = json.loads(line)
+			except json.JSONDecodeError as e:
+				raise ValueError(f'line {n}: {e}') from e
+			if not isinstance(record, dict):
+				raise ValueError(f'line {n}: record is not an object')
+			id = record.get(id_field)
+			if require_id and id is None:
+				raise ValueError(f'line {n}: {id_field} is missing')
+			text = record.get(text_field)
+			if text is None:
+				text = ''
+			elif not isinstance(text, str):
+				raise ValueError(f'line {n}: {text_field} is not a string')
+		except ValueError as e:
+			if on_error is None:
+				raise
+			on_error(n, id, str(e))
+			continue
+		yield id, text
+
+
+def batched(iterable, size: int) -> Generator[list, None, None]:
+	it = iter(iterable)
+	while True:
+		batch = list(itertools.islice(it, max(size, 1)))
+		if not batch:
+			return
+		yield batch
+
+
 def load_corpus_definition(filename: str) -> list:
 	"""
 	Load corpus definition file
@@ -358,6 +1081,72 @@ def load_corpus_from_def(corpus_def: str, corpus_dir: str, op_char: dict, kanji_
 	return corpus, definition
 
 
+def load_document_counts(corpus_dir: str, definition: list, operative: dict, kanji_code: str = None) -> list:
+	"""
+	Load the n-gram frequencies of each document in the definition
+	"""
+	return [load_text('/'.join([corpus_dir, d[0]]), d[1] or kanji_code, operative) for d in definition]
+
+
+def add_document_counts(corpus: dict, text: dict, grade: int, grades: int, sign: int = 1) -> dict:
+	"""
+	Add (sign=1) or subtract (sign=-1) document frequencies to/from corpus
+	"""
+	for key in text:
+		if key not in corpus:
+			corpus[key] = [0] * (grades+1)
+		corpus[key][grade] += sign * text[key][0]
+		corpus[key][0] += sign * text[key][0]
+	return corpus
+
+
+def sweep(corpus_dir: str, definition: list, operative: dict, kanji_code: str, partition: int,
+		  frequencies: list, voting_lists: list) -> list:
+	"""
+	Cross validation over a grid of required frequencies and voting lists
+
+	Each document is loaded once; every model is pruned from the shared counts and
+	every voting list is evaluated from the same likelihoods.
+	Returns rows of [required_frequency, voting_list, accuracy, adjacent accuracy, samples].
+	"""
+	grades = max(int(d[2]) for d in definition)
+
+	# Step 1: Load every document once
+	texts = load_document_counts(corpus_dir, definition, operative, kanji_code)
+	corpus = dict()
+	for d, text in zip(definition, texts):
+		add_document_counts(corpus, text, int(d[2]), grades)
+
+	# Step 2: Divide the sample (partition 1 is leave-one-out)
+	n = len(definition) if partition == 1 else partition
+	folds = [range(p, len(definition), n) for p in range(n)]
+
+	votings = [Result.smoothing_to_voting_list(v) for v in voting_lists]
+	hits = [[[0, 0] for _ in votings] for _ in frequencies]
+
+	# Step 3: Run for each partition
+	for fold in folds:
+		for i in fold:
+			add_document_counts(corpus, texts[i], int(definition[i][2]), grades, -1)
+		for j, frequency in enumerate(frequencies):
+			# Create language model from the pruned counts
+			model = make_model({k: v for k, v in corpus.items() if v[0] >= max(frequency, 1)}, 0)
+			for i in fold:
+				grade = int(definition[i][2])
+				result = Result(texts[i], model.score_counts(texts[i]), model.model_spec)
+				for k, voting in enumerate(votings):
+					result.set_voting_list(voting)
+					estimation = result.grade()
+					hits[j][k][0] += estimation == grade
+					hits[j][k][1] += abs(estimation - grade) <= 1
+		for i in fold:
+			add_document_counts(corpus, texts[i], int(definition[i][2]), grades)
+
+	total = len(definition)
+	return [[frequency, voting, hits[j][k][0] / total, hits[j][k][1] / total, total]
+			for j, frequency in enumerate(frequencies) for k, voting in enumerate(voting_lists)]
+
+
 def corpus_size(corpus_def: str, corpus_dir: str, op_char: dict = None) -> None:
 	"""
 	Corpus size
@@ -401,7 +1190,7 @@ def make_model(corpus: dict, required_frequency: int) -> Model:
 	"""
 	# Delete infrequent bigrams
 	if required_frequency > 0:
-		for key, value in corpus.items():
+		for key, value in list(corpus.items()):
 			if value[0] < required_frequency:
 				del corpus[key]
 
@@ -426,7 +1215,7 @@ def make_total_bigram(corpus: dict) -> dict:
 	total = dict()
 	for key in corpus:
 		f = key[0]  # Get first character
-		total[f] = add_list(total[f], corpus[key])
+		total[f] = add_list(total.get(f), corpus[key])
 	return total
 
 
@@ -441,6 +1230,10 @@ def make_total_unigram(corpus: dict) -> dict:
 	return total
 
 
+def add_likelihoods(total: list, add: list) -> list:
+	return [x + y for x, y in itertools.zip_longest(total, add, fillvalue=0)]
+
+
 def add_list(sum: list, add: list) -> list:
 	if sum:
 		for i in range(len(sum)):
@@ -488,7 +1281,7 @@ def interpolate(f: list) -> list:
 
 
 def interpolate_sub(v: list, zeros: list) -> list:
-	new = list()
+	new = [0.0] * len(v)
 	for i in range(len(v)):
 		if zeros[i]:
 			if i == 0:
@@ -507,6 +1300,10 @@ def load_model(model_spec: str, model_dir: str, required_frequency: int) -> Mode
 
 
 def load_model_file(filename: str, required_frequency: int, model_spec: str = None) -> Model:
+	with open(filename, 'rb') as f:
+		if f.read(len(QuantizedModel.Magic)) == QuantizedModel.Magic:
+			return load_quantized_model_file(filename, required_frequency, model_spec)
+
 	model = dict()
 	with open(filename, 'r', encoding='utf-8') as f:
 		for line in f:
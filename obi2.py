@@ -11,10 +11,12 @@
 ############################################################################
 
 import argparse
+import json
 import nagoyaobi
 import re
 import sys
 from argparse import RawTextHelpFormatter
+from typing import Tuple
 
 KCODE = 'utf8'
 
@@ -34,6 +36,12 @@ class SmoothingAction(argparse.Action):
 		setattr(namespace, self.dest, values)
 
 
+class VotingGridAction(argparse.Action):
+	def __call__(self, parser, namespace, values, option_string=None):
+		values = [[int(v) for v in value.split(',')] for value in values]
+		setattr(namespace, self.dest, values)
+
+
 def init_argparse() -> argparse.ArgumentParser:
 	parser = argparse.ArgumentParser(
 		# usage='%(prog)s [switches] [files]',
@@ -64,16 +72,40 @@ def init_argparse() -> argparse.ArgumentParser:
 
 	parser.add_argument('-f', '--required_frequency', type=int, default=1)
 	parser.add_argument('-s', '--smoothing', action=SmoothingAction)
+	parser.add_argument('-F', '--frequency_grid', type=int, nargs='+',
+						help='required frequencies to evaluate in sweep mode')
+	parser.add_argument('-V', '--voting_grid', nargs='+', action=VotingGridAction,
+						help='voting lists to evaluate in sweep mode, e.g. 0,4,2 0 4')
 
 	parser.add_argument('-O', '--model_output')
+	parser.add_argument('-Q', '--quantize', choices=['int8', 'int16', 'float16'], help='quantize model weights')
 
 	parser.add_argument('-l', '--long_output', action='store_true', help='display long output')
 	parser.add_argument('-T', '--tail_output', action='store_true')
 	parser.add_argument('-L', '--likelihood', action='store_true', help='display likelihood values of levels')
 
-	parser.add_argument('-x', '--exec_mode', choices=['size', 'bigram', 'cross_validation'])
+	parser.add_argument('-A', '--approximate', action='store_true',
+						help='stop reading a text once its estimation settles')
+	parser.add_argument('--approx_step', type=int, default=2000, help='n-grams read between checks')
+	parser.add_argument('--approx_stable', type=int, default=3, help='unchanged checks required to stop')
+	parser.add_argument('--approx_tolerance', type=float, default=1.0, help='allowed change of likelihoods')
+	parser.add_argument('--approx_sample', type=float, default=1.0, help='fraction of lines to read')
+	parser.add_argument('--seed', type=int, default=0)
+
+	parser.add_argument('-x', '--exec_mode',
+						choices=['size', 'bigram', 'cross_validation', 'sweep', 'stream', 'approx_check',
+												'quantize_check', 'store', 'rescore'])
 	parser.add_argument('-p', '--partition', type=int, default=2)
 
+	parser.add_argument('-b', '--batch_size', type=int, default=1, help='records scored per batch in stream mode')
+	parser.add_argument('--id_field', default='id', help='record id field in stream mode')
+	parser.add_argument('--text_field', default='text', help='record text field in stream mode')
+
+	parser.add_argument('-S', '--store', help='document store file for store and rescore modes')
+
+	parser.add_argument('-P', '--processes', type=int, help='evaluate files in a pool of worker processes')
+	parser.add_argument('--shared_model', action='store_true', help='share the model with workers via shared memory')
+
 	parser.add_argument('-i', '--input', nargs='+')
 
 	parser.add_argument('-v', '--version', action='version', version=f'{parser.prog} {Version}\n'
@@ -83,9 +115,79 @@ def init_argparse() -> argparse.ArgumentParser:
 	return parser
 
 
+def load_model(args: dict) -> nagoyaobi.Model:
+	if args['model_file']:
+		return nagoyaobi.load_model_file(args['model_file'], args['required_frequency'])
+	else:
+		return nagoyaobi.load_model(args['model_name'] or DefaultModelName, ModelDir, args['required_frequency'])
+
+
+def approx_param(args: dict) -> dict:
+	return {'step': args['approx_step'], 'stable': args['approx_stable'], 'tolerance': args['approx_tolerance'],
+			'sample': args['approx_sample'], 'seed': args['seed']}
+
+
+def readability(model: nagoyaobi.Model, io_spec, kanji_code_spec: str, op_char: dict, args: dict) \
+		-> Tuple[nagoyaobi.Result, list]:
+	if args['approximate']:
+		result, complete = model.readability_approx(io_spec, kanji_code_spec, op_char, args['smoothing'],
+													**approx_param(args))
+		return result, ['complete' if complete else 'partial']
+	else:
+		return model.readability(io_spec, kanji_code_spec, op_char, args['smoothing']), []
+
+
+def readability_pool(model: nagoyaobi.Model, specs: list, infos: list, op_char: dict, args: dict,
+					 show_param: dict) -> None:
+	if args['shared_model']:
+		model = nagoyaobi.SharedModel.create(model)
+	try:
+		memory = list()
+		light = not ('long' in show_param or 'likelihood' in show_param)
+		for (result, m), info in zip(nagoyaobi.readability_pool(model, specs, op_char, args['smoothing'],
+																  args['processes'], light), infos):
+			if light:
+				nagoyaobi.Result.show_grade(*result, info, show_param)
+			else:
+				result.show(info, show_param)
+			memory.append(m)
+		if memory:
+			print(f'worker private memory growth: max {max(memory)} kB', file=sys.stderr)
+	finally:
+		if args['shared_model']:
+			model.unlink()
+
+
+def record_error(n: int, id, message: str) -> None:
+	sys.stderr.write(json.dumps({'line': n, 'id': id, 'error': message}, ensure_ascii=False) + '\n')
+
+
+def stream_records(model: nagoyaobi.Model, io, op_char: dict, args: dict, show_param: dict) -> None:
+	records = nagoyaobi.records_from_jsonl(io, args['id_field'], args['text_field'], record_error)
+	if 'long' in show_param or 'likelihood' in show_param:
+		for id, result in model.readability_stream(records, op_char, args['smoothing'], args['batch_size']):
+			sys.stdout.write(json.dumps(result.record(id, show_param), ensure_ascii=False) + '\n')
+	else:
+		for id, grade, operative_len in model.grade_stream(records, op_char, args['smoothing'], args['batch_size']):
+			record = {'id': id, 'grade': grade, 'operative': operative_len}
+			sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
 def main() -> None:
 	parser = init_argparse()
 	args = vars(parser.parse_args())
+	if args['approx_step'] < 1:
+		parser.error('--approx_step must be at least 1')
+	if args['approx_stable'] < 1:
+		parser.error('--approx_stable must be at least 1')
+	if not 0.0 < args['approx_sample'] <= 1.0:
+		parser.error('--approx_sample must be in (0, 1]')
+	if args['exec_mode'] in ['approx_check', 'quantize_check'] and not (args['test_def'] or args['input']):
+		parser.error(f"{args['exec_mode']} requires a reference set (--test_def or --input)")
+	if args['processes'] and args['approximate']:
+		parser.error('--approximate cannot be combined with --processes')
+	if args['exec_mode'] in ['store', 'rescore'] and not args['store']:
+		parser.error(f"{args['exec_mode']} requires a document store file (--store)")
 
 	show_param = dict()
 	if args['long_output']:
@@ -161,13 +263,84 @@ def main() -> None:
 						model.readability('/'.join([args['corpus_dir'], x[0]]), x[1] or args['kanji'], op_char,
 										  args['smoothing'])\
 							.show(x, show_param)
+		elif args['exec_mode'] == 'sweep':  # Evaluation experiment mode over a parameter grid
+			definition = nagoyaobi.load_corpus_definition(args['corpus_def'])
+			frequencies = args['frequency_grid'] or [args['required_frequency']]
+			voting_lists = args['voting_grid'] or [args['smoothing'] or [0, 4, 2]]
+			separator = show_param.get('separator', ' ')
+			for row in nagoyaobi.sweep(args['corpus_dir'], definition, op_char, args['kanji'], args['partition'],
+									   frequencies, voting_lists):
+				print(row[0], ','.join(str(v) for v in row[1]), f'{row[2]:.4f}', f'{row[3]:.4f}', row[4],
+					  sep=separator, end='\n')
+		elif args['exec_mode'] == 'stream':  # JSON Lines record mode
+			model = load_model(args)
+			if args['quantize']:
+				model = nagoyaobi.quantize_model(model, args['quantize'])
+			if not args['input']:
+				stream_records(model, sys.stdin, op_char, args, show_param)
+			else:
+				for file in args['input']:
+					with open(file, 'r', encoding='utf-8') as f:
+						stream_records(model, f, op_char, args, show_param)
+		elif args['exec_mode'] == 'approx_check':  # Compare approximate and full evaluation
+			model = load_model(args)
+			if args['test_def']:
+				specs = [('/'.join([args['corpus_dir'], info[0]]), info[1] or args['kanji'])
+						 for info in nagoyaobi.load_corpus_definition(args['test_def'])]
+			else:
+				specs = [(file, args['kanji']) for file in args['input']]
+			rows = nagoyaobi.approximation_agreement(model, specs, op_char, args['smoothing'], **approx_param(args))
+			separator = show_param.get('separator', ' ')
+			for row, spec in zip(rows, specs):
+				print(*row, spec[0], sep=separator, end='\n')
+			if rows:
+				agreement = sum(row[0] == row[1] for row in rows) / len(rows)
+				consumed = sum(row[3] for row in rows) / max(sum(row[2] for row in rows), 1)
+				print('agreement', f'{agreement:.4f}', 'consumed', f'{consumed:.4f}', sep=separator, end='\n')
+		elif args['exec_mode'] == 'quantize_check':  # Compare original and quantized model
+			model = load_model(args)
+			quantized = nagoyaobi.quantize_model(model, args['quantize'] or 'int8')
+			if args['test_def']:
+				specs = [('/'.join([args['corpus_dir'], info[0]]), info[1] or args['kanji'])
+						 for info in nagoyaobi.load_corpus_definition(args['test_def'])]
+			else:
+				specs = [(file, args['kanji']) for file in args['input']]
+			rows = nagoyaobi.compare_models(model, quantized, specs, op_char, args['smoothing'])
+			separator = show_param.get('separator', ' ')
+			for row, spec in zip(rows, specs):
+				print(*row, spec[0], sep=separator, end='\n')
+			if rows:
+				changed = sum(row[0] != row[1] for row in rows) / len(rows)
+				print('changed', f'{changed:.4f}', 'weight_bytes', len(quantized.model.weights) *
+					  quantized.model.weights.itemsize, sep=separator, end='\n')
+		elif args['exec_mode'] == 'store':  # Save document frequencies
+			with nagoyaobi.DocumentStoreWriter(args['store']) as store:
+				if args['test_def']:
+					for info in nagoyaobi.load_corpus_definition(args['test_def']):
+						store.add(info[0], nagoyaobi.load_text('/'.join([args['corpus_dir'], info[0]]),
+															   info[1] or args['kanji'], op_char))
+				elif args['input']:
+					for file in args['input']:
+						store.add(file, nagoyaobi.load_text(file, args['kanji'], op_char))
+				else:
+					# Read JSON Lines records from stdin
+					for id, text in nagoyaobi.records_from_jsonl(sys.stdin, args['id_field'], args['text_field'],
+																  record_error, True):
+						try:
+							store.add(str(id), nagoyaobi.load_text(text.splitlines(), None, op_char))
+						except ValueError as e:
+							record_error(None, id, str(e))
+		elif args['exec_mode'] == 'rescore':  # Evaluate the document store
+			model = load_model(args)
+			if args['quantize']:
+				model = nagoyaobi.quantize_model(model, args['quantize'])
+			for id, result in nagoyaobi.load_document_store(args['store']).rescore(model, args['smoothing']):
+				result.show([id], show_param)
 		else:  # Normal execution mode
 			# Step 1: Prepare model
 			# Load the model if given
-			if args['model_file']:
-				model = nagoyaobi.load_model_file(args['model_file'], args['required_frequency'])
-			elif args['model_name']:
-				model = nagoyaobi.load_model(args['model_name'], ModelDir, args['required_frequency'])
+			if args['model_file'] or args['model_name']:
+				model = load_model(args)
 			elif args['corpus_def']:
 				# Load corpus criteria
 				corpus, definition = nagoyaobi.load_corpus_from_def(args['corpus_def'], args['corpus_dir'], op_char,
@@ -175,19 +348,34 @@ def main() -> None:
 				# Create language model
 				model = nagoyaobi.make_model(corpus, args['required_frequency'])
 				# Save language model
-				if args['model_output']:
+				if args['model_output'] and not args['quantize']:
 					model.save_model(args['model_output'])
 			else:
 				model = nagoyaobi.load_model(DefaultModelName, ModelDir, args['required_frequency'])
+			if args['quantize']:
+				model = nagoyaobi.quantize_model(model, args['quantize'])
+				# Save quantized model
+				if args['model_output']:
+					model.save_model(args['model_output'])
 
 			# Step 2: Evaluate difficulty
-			if args['test_def']:
+			if args['processes'] and (args['test_def'] or args['input']):
+				# Evaluate in a worker pool
+				if args['test_def']:
+					infos = nagoyaobi.load_corpus_definition(args['test_def'])
+					specs = [('/'.join([args['corpus_dir'], info[0]]), info[1] or args['kanji']) for info in infos]
+				else:
+					infos = [[file] for file in args['input']]
+					specs = [(file, args['kanji']) for file in args['input']]
+				readability_pool(model, specs, infos, op_char, args, show_param)
+			elif args['test_def']:
 				# The text file to be evaluated is specified by --test_def
 				definition = nagoyaobi.load_corpus_definition(args['test_def'])
 				for info in definition:
-					model.readability('/'.join([args['corpus_dir'], info[0]]), info[1] or args['kanji'], op_char,
-									  args['smoothing']).show(info, show_param)
-			elif len(args['input']) == 0:
+					result, extra = readability(model, '/'.join([args['corpus_dir'], info[0]]),
+												info[1] or args['kanji'], op_char, args)
+					result.show(info + extra, show_param)
+			elif not args['input']:
 				if args['model_output']:
 					# Model creation only; Difficulty evaluation not performed
 					pass
@@ -195,16 +383,21 @@ def main() -> None:
 					# Read the filename to be evaluated from stdin
 					for line in sys.stdin:
 						line = re.split(r'\s+', line.strip('\r\n'))
-						model.readability('/'.join([args['corpus_dir'], line[0]]), line[1] or args['kanji'], op_char,
-										  args['smoothing']).show(line, show_param)
+						result, extra = readability(model, '/'.join([args['corpus_dir'], line[0]]),
+													line[1] or args['kanji'], op_char, args)
+						result.show(line + extra, show_param)
+				elif args['approximate']:
+					# Read the text to be evaluated from stdin
+					result, extra = readability(model, sys.stdin, args['kanji'], op_char, args)
+					result.show(extra, show_param)
 				else:
 					# Read the text to be evaluated from stdin
 					model.readability(sys.stdin, args['kanji'], op_char).show([], show_param)
 			else:
 				# The filename to be evaluated is specified in the arguments
 				for file in args['input']:
-					model.readability(file, args['kanji'], op_char, args['smoothing'])\
-						.show([file], show_param)
+					result, extra = readability(model, file, args['kanji'], op_char, args)
+					result.show([file] + extra, show_param)
 
 
 if __name__ == '__main__':